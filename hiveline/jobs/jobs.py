@@ -1,9 +1,9 @@
 import datetime
-import threading
 import time
 from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from enum import Enum
-from typing import Callable
+from typing import Any, Callable, Iterable
 
 
 class JobStatus(Enum):
@@ -37,7 +37,7 @@ class JobStatus(Enum):
 
 class JobsDataSource(ABC):
     @abstractmethod
-    def create_jobs(self, sim_id: str, service_name: str, job_ids: list[str]):
+    def create_jobs(self, sim_id: str, service_name: str, job_ids: Iterable[str]):
         """
         Creates the jobs in the data source. If the job already exists (uniquely identified by service_name, sim_id, job_id),
         it is not created again. Use reset_jobs and reset_failed_jobs to reset the status of existing jobs.
@@ -72,6 +72,27 @@ class JobsDataSource(ABC):
         """
         pass
 
+    def pop_jobs(self, sim_id: str, service_name: str, count: int,
+                 max_started_date: datetime.datetime = None) -> list[str]:
+        """
+        Pops up to count jobs from the data source in one go. If no job is available, returns an empty list. It will
+        automatically set the status of the jobs to "started". Data sources that can claim multiple jobs at once should
+        override this, by default it falls back to pop_job (which ignores max_started_date).
+        :param sim_id: the simulation ID
+        :param service_name: the name of the service
+        :param count: the maximum number of jobs to pop
+        :param max_started_date: (optional) started jobs with an earlier started date are considered timed out and
+        can be popped again
+        :return: the job IDs
+        """
+        job_ids = []
+        for _ in range(count):
+            job_id = self.pop_job(sim_id, service_name)
+            if job_id is None:
+                break
+            job_ids.append(job_id)
+        return job_ids
+
     @abstractmethod
     def update_job(self, sim_id: str, service_name: str, job_id: str, status: JobStatus, error: str | None = None):
         """
@@ -85,13 +106,52 @@ class JobsDataSource(ABC):
         """
         pass
 
+    def update_jobs(self, sim_id: str, service_name: str, job_ids: list[str], status: JobStatus,
+                    error: str | None = None):
+        """
+        Updates the status of multiple jobs at once. Data sources that can update multiple jobs in one go should
+        override this, by default it falls back to update_job.
+        :param sim_id: the simulation ID
+        :param service_name: the name of the service
+        :param job_ids: the job IDs
+        :param status: the new status
+        :param error: (optional) the error message
+        :return:
+        """
+        for job_id in job_ids:
+            self.update_job(sim_id, service_name, job_id, status, error)
+
+    def touch_jobs(self, sim_id: str, service_name: str, job_ids: list[str]):
+        """
+        Refreshes the started date of started jobs, so they are not considered timed out while a worker still holds
+        them. Jobs with another status are not changed. By default, nothing is refreshed, so jobs time out relative to
+        when they were claimed.
+        :param sim_id: the simulation ID
+        :param service_name: the name of the service
+        :param job_ids: the job IDs
+        :return:
+        """
+        pass
+
     @abstractmethod
-    def count_jobs(self, sim_id: str, service_name: str, status: JobStatus = None) -> int:
+    def count_jobs(self, sim_id: str, service_name: str, status: JobStatus = None,
+                   max_started_date: datetime.datetime = None) -> int:
         """
         Counts the number of jobs. If status is not None, only jobs with the specified status are counted.
         :param sim_id: the simulation ID
         :param service_name: the name of the service
         :param status: (optional) the status of the jobs to count
+        :param max_started_date: (optional) the maximum started date of the jobs to count
+        :return:
+        """
+        pass
+
+    def archive_jobs(self, sim_id: str, service_name: str):
+        """
+        Moves finished and failed jobs out of the active job set, so claiming and counting pending jobs stays cheap.
+        Archived jobs are still counted, reset and deleted like other jobs. By default, nothing is archived.
+        :param sim_id: the simulation ID
+        :param service_name: the name of the service
         :return:
         """
         pass
@@ -107,13 +167,124 @@ class JobsDataSource(ABC):
         pass
 
 
+def run_job_pool(claim: Callable[[int], list], process: Callable[[Any], Exception | None],
+                 release: Callable[[list], None], threads=4, batch_size=32, max_consecutive_errors=5,
+                 tick: Callable[[int, Any], None] | None = None, on_stop: Callable[[], None] | None = None,
+                 heartbeat: Callable[[list], None] | None = None, heartbeat_interval=60.0) -> Exception | None:
+    """
+    Claims jobs in batches and processes them on a pool of worker threads until there are no jobs left. If the pool is
+    stopped early (too many consecutive errors, CTRL+C, SIGTERM, an error in the callbacks), the queued jobs are not
+    run but released, only the jobs that are already running are waited for.
+    :param claim: claims up to the given number of jobs and returns them (an empty list if there are none left)
+    :param process: processes a job and returns the exception if it failed, None otherwise
+    :param release: puts claimed jobs that were not started back, so they can be claimed again right away
+    :param threads: the number of worker threads
+    :param batch_size: the number of jobs to claim at once
+    :param max_consecutive_errors: the number of consecutive failed jobs after which the pool is stopped
+    :param tick: (optional) called after each round of processed jobs with the number of processed jobs so far and the
+    last processed job
+    :param on_stop: (optional) called when the pool is stopped early, after the queued jobs were released and before
+    the running ones are waited for
+    :param heartbeat: (optional) refreshes the started date of the claimed jobs that are not processed yet (queued or
+    running), so they don't time out while this pool still holds them
+    :param heartbeat_interval: the number of seconds between heartbeats
+    :return: the error of the last job if the pool was stopped because of too many consecutive errors, None otherwise
+    """
+    executor = ThreadPoolExecutor(max_workers=threads)
+    running = {}
+    has_pending = True
+
+    # by default, we will not stop the process if there is one error, but if there are multiple consecutive errors,
+    # we will stop the process
+    consecutive_error_number = 0
+
+    processed_jobs = 0
+    last_heartbeat = time.time()
+
+    try:
+        while True:
+            # claim the next batch once fewer jobs are queued than there are workers, so workers don't idle while we
+            # claim. the heartbeat keeps the started date of queued jobs fresh, so they can wait in the queue
+            if has_pending and len(running) < 2 * threads:
+                jobs = claim(batch_size)
+                has_pending = len(jobs) > 0
+
+                for job in jobs:
+                    running[executor.submit(process, job)] = job
+
+                continue
+
+            if len(running) == 0:
+                return None
+
+            done, _ = wait(running.keys(), timeout=heartbeat_interval if heartbeat is not None else None,
+                           return_when=FIRST_COMPLETED)
+
+            if heartbeat is not None and time.time() - last_heartbeat >= heartbeat_interval:
+                heartbeat(list(running.values()))
+                last_heartbeat = time.time()
+
+            if len(done) == 0:
+                continue
+
+            job = None
+            for future in done:
+                job = running.pop(future)
+                error = future.result()
+                processed_jobs += 1
+
+                if error is None:
+                    consecutive_error_number = 0
+                    continue
+
+                consecutive_error_number += 1
+
+                if consecutive_error_number > max_consecutive_errors:
+                    _stop_job_pool(executor, running, release, on_stop)
+                    return error
+
+            if tick is not None:
+                tick(processed_jobs, job)
+    except BaseException:
+        # also on CTRL+C or SIGTERM, so we don't work through all queued jobs before stopping
+        _stop_job_pool(executor, running, release, on_stop)
+        raise
+    finally:
+        executor.shutdown()
+
+
+def _stop_job_pool(executor: ThreadPoolExecutor, running: dict, release: Callable[[list], None],
+                   on_stop: Callable[[], None] | None):
+    """
+    Stops the worker pool without running the queued jobs. Queued jobs are released, the jobs that are already running
+    are waited for.
+    :param executor: the worker pool
+    :param running: the futures of the submitted jobs that were not processed yet, mapped to their jobs
+    :param release: puts claimed jobs that were not started back
+    :param on_stop: (optional) called before the running jobs are waited for
+    :return:
+    """
+    executor.shutdown(wait=False, cancel_futures=True)
+
+    cancelled = [job for (future, job) in running.items() if future.cancelled()]
+    if len(cancelled) > 0:
+        release(cancelled)
+
+    if on_stop is not None:
+        on_stop()
+
+    executor.shutdown(wait=True)
+
+
 class JobHandler:
-    def __init__(self, service_name: str, sim_id: str, data_source: JobsDataSource):
+    def __init__(self, service_name: str, sim_id: str, data_source: JobsDataSource,
+                 job_timeout: datetime.timedelta = datetime.timedelta(minutes=5)):
         self.service_name = service_name
         self.sim_id = sim_id
         self.data_source = data_source
+        self.job_timeout = job_timeout
 
-    def create_jobs(self, job_ids: list[str]):
+    def create_jobs(self, job_ids: Iterable[str]):
         self.data_source.create_jobs(self.sim_id, self.service_name, job_ids)
 
     def reset_jobs(self):
@@ -121,68 +292,131 @@ class JobHandler:
 
     def reset_timed_out_jobs(self):
         self.data_source.reset_jobs(self.sim_id, self.service_name, status=[JobStatus.STARTED],
-                                    max_started_date=datetime.datetime.now() - datetime.timedelta(minutes=5))
+                                    max_started_date=self.__get_timeout_date())
 
     def reset_failed_jobs(self):
         self.data_source.reset_jobs(self.sim_id, self.service_name, status=[JobStatus.FAILED])
 
-    def iterate_jobs(self, handler: Callable[[str], None], threads=4, debug_progress=True, max_consecutive_errors=5):
-        if threads > 1:
-            self._spawn_threads(handler, threads, debug_progress, max_consecutive_errors)
-            return
-
-        self._iterate_jobs(handler, debug_progress, max_consecutive_errors)
-
-    def _spawn_threads(self, handler: Callable[[str], None], num_threads=4, debug_progress=True,
-                       max_consecutive_errors=5):
-        threads = []
-        for i in range(num_threads):
-            t = threading.Thread(target=self._iterate_jobs,
-                                 args=(handler, debug_progress and i == 0, max_consecutive_errors))
-            t.start()
-            threads.append(t)
-
-        for t in threads:
-            t.join()
+    def iterate_jobs(self, handler: Callable[[str], bool | None], threads=4, debug_progress=True,
+                     max_consecutive_errors=5, batch_size=32,
+                     flush: Callable[[], tuple[list[str], list[tuple[str, str]]]] | None = None, flush_size=100,
+                     flush_delay=1.0, archive_size=1000):
+        """
+        Claims pending jobs in batches and runs the handler for each of them on a pool of worker threads. The job
+        status is set to finished or failed depending on whether the handler raised an exception.
+        :param handler: the function to run for each job ID
+        :param threads: the number of worker threads
+        :param debug_progress: whether to print the progress
+        :param max_consecutive_errors: the number of consecutive failed jobs after which the iteration is stopped
+        :param batch_size: the number of jobs to claim at once
+        :param flush: (optional) writes the results the handlers buffered and returns the IDs of the jobs whose results
+        were written and (job ID, error) tuples of the ones that were rejected. If set, handlers that buffered their
+        results return True and their jobs are only set to finished once a flush reports them as written
+        :param flush_size: the number of processed jobs since the last flush that triggers a flush
+        :param flush_delay: the number of seconds since the last flush that triggers a flush
+        :param archive_size: the number of processed jobs after which finished and failed jobs are archived during the
+        run. Jobs with buffered results are only finished after their flush, so only durable jobs are archived
+        :return:
+        """
+        # move finished jobs of earlier runs out of the way before claiming
+        self.data_source.archive_jobs(self.sim_id, self.service_name)
 
-    def _iterate_jobs(self, handler: Callable[[str], None], debug_progress=True, max_consecutive_errors=5):
-        # get the total number of jobs
+        # the total is only needed for progress output
         total_jobs = 0
         if debug_progress:
-            total_jobs = self.data_source.count_jobs(self.sim_id, self.service_name, status=JobStatus.PENDING)
-
-        # by default, we will not stop the process if there is one error, but if there are multiple consecutive errors,
-        # we will stop the process
-        consecutive_error_number = 0
+            total_jobs = self.count_claimable_jobs()
 
         last_print = 0
+        last_archive = 0
+        last_flush = time.time()
+        flushed_jobs = 0
 
-        while True:
-            job_id = self.data_source.pop_job(self.sim_id, self.service_name)
-            if job_id is None:
-                break
+        def tick(processed_jobs: int, job_id: str):
+            nonlocal last_print, last_archive, last_flush, flushed_jobs
+
+            if flush is not None and (processed_jobs - flushed_jobs >= flush_size or
+                                      time.time() - last_flush >= flush_delay):
+                self.__flush_jobs(flush)
+                flushed_jobs = processed_jobs
+                last_flush = time.time()
+
+            # keep the active job set small while the run is going, not just between runs
+            if processed_jobs - last_archive >= archive_size:
+                self.data_source.archive_jobs(self.sim_id, self.service_name)
+                last_archive = processed_jobs
 
             current_time = time.time()
             if debug_progress and current_time - last_print > 1:
                 last_print = current_time
-                pending_jobs = self.data_source.count_jobs(self.sim_id, self.service_name, status=JobStatus.PENDING)
-                print("Progress: ~{:.2f}% {:}".format(100 * (1 - pending_jobs / total_jobs), job_id))
+                print("Progress: ~{:.2f}% {:}".format(100 * min(1.0, processed_jobs / max(total_jobs, 1)), job_id))
+
+        try:
+            error = run_job_pool(
+                # timed out jobs are claimed again right away, so they don't have to be reset beforehand
+                lambda count: self.data_source.pop_jobs(self.sim_id, self.service_name, count,
+                                                        max_started_date=self.__get_timeout_date()),
+                lambda job_id: self._run_job(handler, job_id, flush is not None),
+                lambda job_ids: self.data_source.update_jobs(self.sim_id, self.service_name, job_ids,
+                                                             JobStatus.PENDING),
+                threads=threads, batch_size=batch_size, max_consecutive_errors=max_consecutive_errors, tick=tick,
+                # write what is already done first, in case we are killed while waiting for the running jobs
+                on_stop=(lambda: self.__flush_jobs(flush)) if flush is not None else None,
+                heartbeat=lambda job_ids: self.data_source.touch_jobs(self.sim_id, self.service_name, job_ids),
+                heartbeat_interval=self.job_timeout.total_seconds() / 3)
+        finally:
+            if flush is not None:
+                self.__flush_jobs(flush)
+
+        if error is not None:
+            raise error
+
+        self.data_source.archive_jobs(self.sim_id, self.service_name)
+
+    def _run_job(self, handler: Callable[[str], bool | None], job_id: str, defer_finish=False) -> Exception | None:
+        try:
+            buffered = handler(job_id)
+
+            # jobs with buffered results are set to finished by the flush that writes them
+            if not (defer_finish and buffered):
+                self.data_source.update_job(self.sim_id, self.service_name, job_id, JobStatus.FINISHED)
 
-            try:
-                handler(job_id)
+            return None
+        except Exception as e:
+            print(f"Error processing job {job_id}: {e}")
 
-                consecutive_error_number = 0
+            # set status to failed
+            self.data_source.update_job(self.sim_id, self.service_name, job_id, JobStatus.FAILED, str(e))
 
-                self.data_source.update_job(self.sim_id, self.service_name, job_id, JobStatus.FINISHED)
-            except Exception as e:
-                consecutive_error_number += 1
-                print(f"Error processing job {job_id}: {e}")
+            return e
 
-                # set status to failed
-                self.data_source.update_job(self.sim_id, self.service_name, job_id, JobStatus.FAILED, str(e))
+    def __flush_jobs(self, flush: Callable[[], tuple[list[str], list[tuple[str, str]]]]):
+        """
+        Writes the buffered results. Jobs whose results were written are set to finished, jobs whose results were
+        rejected are set to failed. If the write fails as a whole, the error is raised and the jobs stay started, so
+        they are claimed again after the timeout.
+        :param flush: the function writing the buffered results
+        :return:
+        """
+        written, failed = flush()
 
-                if consecutive_error_number > max_consecutive_errors:
-                    raise e
+        self.data_source.update_jobs(self.sim_id, self.service_name, written, JobStatus.FINISHED)
+
+        for job_id, error in failed:
+            print(f"Error writing the results of job {job_id}: {error}")
+            self.data_source.update_job(self.sim_id, self.service_name, job_id, JobStatus.FAILED, error)
 
     def count_jobs(self, status):
         return self.data_source.count_jobs(self.sim_id, self.service_name, status=status)
+
+    def count_claimable_jobs(self):
+        """
+        Counts the jobs that iterate_jobs would claim, i.e. pending jobs and started jobs that timed out.
+        :return:
+        """
+        pending = self.data_source.count_jobs(self.sim_id, self.service_name, status=JobStatus.PENDING)
+        timed_out = self.data_source.count_jobs(self.sim_id, self.service_name, status=JobStatus.STARTED,
+                                                max_started_date=self.__get_timeout_date())
+        return pending + timed_out
+
+    def __get_timeout_date(self):
+        return datetime.datetime.now() - self.job_timeout
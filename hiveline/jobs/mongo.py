@@ -1,8 +1,10 @@
 import datetime
+from typing import Iterable
 
-import pymongo.errors
+from bson import ObjectId
 
 from hiveline import get_database
+from hiveline.mongo.db import insert_many_ignore_duplicates, ensure_index
 from hiveline.jobs.jobs import JobsDataSource, JobStatus
 
 
@@ -65,25 +67,47 @@ class MongoJob:
         )
 
 
+# finished and failed jobs are moved to the archive collection, so the active collection only holds jobs that still
+# matter to the workers
+archived_status = [str(JobStatus.FINISHED), str(JobStatus.FAILED)]
+
+
 class MongoJobsDataSource(JobsDataSource):
     def __init__(self, db=None):
         self.db = db
         if self.db is None:
             self.db = get_database()
         self.coll = self.db["jobs"]
+        self.archive_coll = self.db["jobs-archive"]
+
+        ensure_index(self.coll, [("service-name", 1), ("sim-id", 1), ("job-id", 1)], unique=True)
+        ensure_index(self.coll, [("service-name", 1), ("sim-id", 1), ("status", 1), ("started", 1)])
+        ensure_index(self.archive_coll, [("service-name", 1), ("sim-id", 1), ("job-id", 1)], unique=True)
+        ensure_index(self.archive_coll, [("service-name", 1), ("sim-id", 1), ("status", 1)])
+
+    def create_jobs(self, sim_id: str, service_name: str, job_ids: Iterable[str]):
+        sim_filter = {
+            "service-name": service_name,
+            "sim-id": sim_id
+        }
+
+        # skip jobs that already exist (active or archived), so we don't send them just to have them rejected by the
+        # unique index
+        existing = set()
+        for coll in [self.coll, self.archive_coll]:
+            existing.update(job["job-id"] for job in coll.find(sim_filter, {"job-id": 1, "_id": 0}).batch_size(5000))
+
+        job_ids = (job_id for job_id in job_ids if job_id not in existing)
 
-    def create_jobs(self, sim_id: str, service_name: str, job_ids: list[str]):
-        for job_id in job_ids:
-            try:
-                self.coll.insert_one(MongoJob(
-                    service_name=service_name,
-                    sim_id=sim_id,
-                    job_id=job_id,
-                    status="pending",
-                    created=datetime.datetime.now()
-                ).to_dict())
-            except pymongo.errors.DuplicateKeyError:
-                pass
+        created = datetime.datetime.now()
+
+        insert_many_ignore_duplicates(self.coll, (MongoJob(
+            service_name=service_name,
+            sim_id=sim_id,
+            job_id=job_id,
+            status="pending",
+            created=created
+        ).to_dict() for job_id in job_ids))
 
     def reset_jobs(self, sim_id: str, service_name: str, status: list[JobStatus] = None, max_started_date=None):
         jobs_filter = {
@@ -101,6 +125,10 @@ class MongoJobsDataSource(JobsDataSource):
                 "$lte": max_started_date
             }
 
+        # move matching archived jobs back to the active collection first
+        if status is None or any(str(s) in archived_status for s in status):
+            self.__move_jobs(self.archive_coll, self.coll, jobs_filter)
+
         self.coll.update_many(jobs_filter, {
             "$set": {
                 "status": "pending"
@@ -125,7 +153,106 @@ class MongoJobsDataSource(JobsDataSource):
         })
         return job["job-id"] if job is not None else None
 
+    def pop_jobs(self, sim_id: str, service_name: str, count: int, max_started_date=None) -> list[str]:
+        jobs_filter = {
+            "service-name": service_name,
+            "sim-id": sim_id,
+            "status": "pending"
+        }
+
+        if max_started_date is not None:
+            # also steal jobs that were started too long ago, so they are picked up again mid-run
+            del jobs_filter["status"]
+            jobs_filter["$or"] = [
+                {"status": "pending"},
+                {"status": "started", "started": {"$lte": max_started_date}}
+            ]
+
+        # updateMany has no limit, so we look up the candidates first and claim them with a token. jobs that were
+        # claimed by another worker in between are not matched by the filter anymore.
+        while True:
+            ids = [job["_id"] for job in self.coll.find(jobs_filter, {"_id": 1}).limit(count)]
+            if len(ids) == 0:
+                return []
+
+            token = ObjectId()
+
+            self.coll.update_many({
+                **jobs_filter,
+                "_id": {
+                    "$in": ids
+                }
+            }, {
+                "$set": {
+                    "status": "started",
+                    "started": datetime.datetime.now(),
+                    "worker-token": token
+                }
+            })
+
+            job_ids = [job["job-id"] for job in self.coll.find({
+                "_id": {
+                    "$in": ids
+                },
+                "worker-token": token
+            }, {"job-id": 1})]
+
+            # if all candidates were taken by other workers in the meantime, we just try again
+            if len(job_ids) > 0:
+                return job_ids
+
     def update_job(self, sim_id: str, service_name: str, job_id: str, status: JobStatus, error: str | None = None):
+        self.coll.update_one({
+            "service-name": service_name,
+            "sim-id": sim_id,
+            "job-id": job_id
+        }, self.__get_update(status, error))
+
+    def update_jobs(self, sim_id: str, service_name: str, job_ids: list[str], status: JobStatus,
+                    error: str | None = None):
+        if len(job_ids) == 0:
+            return
+
+        self.coll.update_many({
+            "service-name": service_name,
+            "sim-id": sim_id,
+            "job-id": {
+                "$in": job_ids
+            }
+        }, self.__get_update(status, error))
+
+    def touch_jobs(self, sim_id: str, service_name: str, job_ids: list[str]):
+        if len(job_ids) == 0:
+            return
+
+        self.coll.update_many({
+            "service-name": service_name,
+            "sim-id": sim_id,
+            "job-id": {
+                "$in": job_ids
+            },
+            "status": "started"
+        }, {
+            "$set": {
+                "started": datetime.datetime.now()
+            }
+        })
+
+    @staticmethod
+    def __get_update(status: JobStatus, error: str | None = None):
+        if status == JobStatus.PENDING:
+            # jobs that are put back (e.g. when stopping a run) are claimable again right away
+            return {
+                "$set": {
+                    "status": str(status)
+                },
+                "$unset": {
+                    "error": "",
+                    "started": "",
+                    "finished": ""
+                }
+            }
+
         update = {
             "$set": {
                 "status": str(status),
@@ -142,13 +269,9 @@ class MongoJobsDataSource(JobsDataSource):
         if status == JobStatus.FINISHED or status == JobStatus.FAILED:
             update["$set"]["finished"] = datetime.datetime.now()
 
-        self.coll.update_one({
-            "service-name": service_name,
-            "sim-id": sim_id,
-            "job-id": job_id
-        }, update)
+        return update
 
-    def count_jobs(self, sim_id: str, service_name: str, status: JobStatus = None) -> int:
+    def count_jobs(self, sim_id: str, service_name: str, status: JobStatus = None, max_started_date=None) -> int:
         jobs_filter = {
             "service-name": service_name,
             "sim-id": sim_id
@@ -157,10 +280,59 @@ class MongoJobsDataSource(JobsDataSource):
         if status is not None:
             jobs_filter["status"] = str(status)
 
-        return self.coll.count_documents(jobs_filter)
+        if max_started_date is not None:
+            jobs_filter["started"] = {
+                "$lte": max_started_date
+            }
+
+        count = self.coll.count_documents(jobs_filter)
+
+        if status is None or str(status) in archived_status:
+            count += self.archive_coll.count_documents(jobs_filter)
+
+        return count
 
     def delete_jobs(self, sim_id: str, service_name: str):
-        self.coll.delete_many({
+        for coll in [self.coll, self.archive_coll]:
+            coll.delete_many({
+                "service-name": service_name,
+                "sim-id": sim_id
+            })
+
+    def archive_jobs(self, sim_id: str, service_name: str):
+        self.__move_jobs(self.coll, self.archive_coll, {
             "service-name": service_name,
-            "sim-id": sim_id
+            "sim-id": sim_id,
+            "status": {
+                "$in": archived_status
+            }
         })
+
+    @staticmethod
+    def __move_jobs(from_coll, to_coll, jobs_filter, chunk_size=10000):
+        """
+        Moves all jobs matching the filter from one collection to another on the server side. The jobs are moved in
+        chunks, so the commands stay well below the BSON size limit for large simulations.
+        :param from_coll: the collection to move the jobs from
+        :param to_coll: the collection to move the jobs to
+        :param jobs_filter: the filter for the jobs to move
+        :param chunk_size: the number of jobs to move per command
+        :return:
+        """
+        ids = [job["_id"] for job in from_coll.find(jobs_filter, {"_id": 1}).batch_size(5000)]
+
+        for i in range(0, len(ids), chunk_size):
+            # match the filter again in both steps, so jobs that changed (e.g. were reset) since the lookup are neither
+            # copied nor deleted
+            chunk_filter = {
+                **jobs_filter,
+                "_id": {
+                    "$in": ids[i:i + chunk_size]
+                }
+            }
+
+            from_coll.aggregate([
+                {"$match": chunk_filter},
+                {"$merge": {"into": to_coll.name, "whenMatched": "replace", "whenNotMatched": "insert"}}
+            ])
+            from_coll.delete_many(chunk_filter)
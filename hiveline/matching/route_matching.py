@@ -1,14 +1,15 @@
 import argparse
-import threading
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import bson.errors
+from bson import ObjectId
 import osmnx as ox
 import pymongo.errors
 
 import historical_osmnx
-from hiveline.mongo.db import get_database
+from hiveline.jobs.jobs import run_job_pool
+from hiveline.mongo.db import get_database, insert_many_ignore_duplicates, ensure_index
 
 
 def __create_matching_jobs(db, sim_id):
@@ -18,63 +19,38 @@ def __create_matching_jobs(db, sim_id):
     :param sim_id: the simulation id
     :return:
     """
-    pipeline = [
-        {
-            "$match": {
-                "sim-id": sim_id,
-                "options": {
-                    "$elemMatch": {
-                        "modes": "CAR",
-                    }
-                },
-            },
-        },
-        {
-            "$lookup": {
-                "from": "matching-jobs",
-                "localField": "vc-id",
-                "foreignField": "vc-id",
-                "as": "matching-jobs"
-            },
-        },
-        {
-            "$match": {
-                "matched_docs": {
-                    "$not": {
-                        "$elemMatch": {
-                            "sim-id": sim_id
-                        }
-                    }
-                }
+    jobs_coll = db["matching-jobs"]
+    coll = db["route-results"]
+
+    # look up existing jobs first instead of joining them in with $lookup, so both queries can use the sim-id index
+    existing_jobs = jobs_coll.find({"sim-id": sim_id}, {"vc-id": 1, "_id": 0}).batch_size(5000)
+    existing = set(job["vc-id"] for job in existing_jobs)
+
+    results_filter = {
+        "sim-id": sim_id,
+        "options": {
+            "$elemMatch": {
+                "modes": "CAR",
             }
         },
-        {
-            "$project": {
-                "vc-id": 1,
-            }
-        }
-    ]
-
-    coll = db["route-results"]
+    }
 
-    result = coll.aggregate(pipeline)
-    jobs_coll = db["matching-jobs"]
+    # for large job sets, the $nin list gets too big to send, so we filter on our side instead
+    if len(existing) <= 100000:
+        results_filter["vc-id"] = {"$nin": list(existing)}
 
-    for route_result in result:
-        vc_id = route_result["vc-id"]
-        created = datetime.now()
+    result = (route_result for route_result in coll.find(results_filter, {"vc-id": 1, "_id": 0}).batch_size(5000)
+              if route_result["vc-id"] not in existing)
 
-        job = {
-            "vc-id": vc_id,
-            "sim-id": sim_id,
-            "created": created,
-            "status": "pending",
-        }
+    created = datetime.now()
 
-        try:
-            jobs_coll.insert_one(job)
-        except pymongo.errors.DuplicateKeyError:
-            continue  # job was created by another process
+    # jobs that were created by another process are skipped
+    insert_many_ignore_duplicates(jobs_coll, ({
+        "vc-id": route_result["vc-id"],
+        "sim-id": sim_id,
+        "created": created,
+        "status": "pending",
+    } for route_result in result))
 
 
 def __reset_jobs(db, sim_id):
@@ -89,9 +65,27 @@ def __reset_jobs(db, sim_id):
                      {"$set": {"status": "pending"}, "$unset": {"error": "", "started": "", "finished": ""}})
 
 
+def __get_claimable_filter(sim_id, timeout=timedelta(minutes=5)):
+    """
+    Get the filter for jobs that can be claimed, i.e. pending jobs and jobs that have been running for longer than the
+    timeout.
+    :param sim_id: the simulation id
+    :param timeout: the time after which a running job is considered timed out
+    :return:
+    """
+    return {
+        "sim-id": sim_id,
+        "$or": [
+            {"status": "pending"},
+            {"status": "running", "started": {"$lt": datetime.now() - timeout}},
+        ]
+    }
+
+
 def __no_active_jobs(db, sim_id):
     jobs_coll = db["matching-jobs"]
-    return jobs_coll.count_documents({"sim-id": sim_id, "status": "pending"}) == 0
+    # timed out jobs are claimed again while matching, so they count as active
+    return jobs_coll.count_documents(__get_claimable_filter(sim_id)) == 0
 
 
 def __process_route_result(route_results_coll, route_result, graph):
@@ -144,107 +138,132 @@ def __process_route_result(route_results_coll, route_result, graph):
     if not has_changed:
         return
 
-    route_results_coll.replace_one({"_id": route_result["_id"]}, route_result)
+    route_results_coll.update_one({"_id": route_result["_id"]}, {"$set": {"options": route_result["options"]}})
 
 
-def __iterate_jobs(db, sim_id, graph, debug=False, progress_fac=1):
+def __claim_batch(jobs_coll, sim_id, k, timeout=timedelta(minutes=5)):
     """
-    Iterate over all matching jobs and run the matching algorithm for each job.
-    :param db: the database
+    Claim up to k pending matching jobs at once. Jobs that have been running for longer than the timeout are claimed
+    again as well. The candidates are looked up first (updateMany has no limit) and then claimed with a worker token,
+    so jobs taken by another thread in the meantime are skipped.
+    :param jobs_coll: the matching jobs collection
     :param sim_id: the simulation id
-    :param graph: the undirected graph to use for the matching
-    :param debug: if True, print debug information
-    :param progress_fac: the progress factor to use (useful for debugging parallel processing)
-    :return:
+    :param k: the maximum number of jobs to claim
+    :param timeout: the time after which a running job is considered timed out
+    :return: the claimed jobs (empty if there are no pending jobs left)
     """
-    jobs_coll = db["matching-jobs"]
-    route_results_coll = db["route-results"]
-
-    # get total number of jobs
-    total_jobs = jobs_coll.count_documents({"sim-id": sim_id, "status": "pending"})
-
-    if total_jobs == 0:
-        return
+    while True:
+        claimable = __get_claimable_filter(sim_id, timeout)
 
-    if debug:
-        print("Running matching algorithm")
+        ids = [job["_id"] for job in jobs_coll.find(claimable, {"_id": 1}).limit(k)]
 
-    # by default, we will not stop the process if there is one error, but if there are multiple consecutive errors,
-    # we will stop the process
-    consecutive_error_number = 0
+        if len(ids) == 0:
+            return []
 
-    job_key = 0
-    last_print = 0
+        token = ObjectId()
 
-    while True:
-        job = jobs_coll.find_one_and_update({
-            "sim-id": sim_id,
-            "status": "pending",
+        jobs_coll.update_many({
+            **claimable,
+            "_id": {"$in": ids},
         }, {
             "$set": {
                 "status": "running",
                 "started": datetime.now(),
+                "worker-token": token,
             }
         })
 
-        if job is None:
-            break
+        jobs = list(jobs_coll.find({"_id": {"$in": ids}, "worker-token": token}))
 
-        job_key += 1
+        if len(jobs) > 0:
+            return jobs
 
-        percentage = job_key / total_jobs * 100
-        current_time = time.time()
-        if debug and current_time - last_print > 1:
-            print("Progress: ~{:.2f}% {:}".format(percentage * progress_fac, job["vc-id"]))
-            last_print = current_time
 
-        try:
-            route_result = route_results_coll.find_one({"vc-id": job["vc-id"], "sim-id": sim_id})
-            __process_route_result(route_results_coll, route_result, graph)
+def __process_job(jobs_coll, route_results_coll, job, sim_id, graph):
+    """
+    Run the matching algorithm for a single job and update the job status.
+    :param jobs_coll: the matching jobs collection
+    :param route_results_coll: the route results collection
+    :param job: the claimed job
+    :param sim_id: the simulation id
+    :param graph: the undirected graph to use for the matching
+    :return: None if the job finished, the exception if it failed
+    """
+    try:
+        route_result = route_results_coll.find_one({"vc-id": job["vc-id"], "sim-id": sim_id}, {"options": 1})
+        __process_route_result(route_results_coll, route_result, graph)
 
-            # set status to finished
-            jobs_coll.update_one({"_id": job["_id"]}, {
-                "$set": {
-                    "status": "finished",
-                    "finished": datetime.now(),
-                }
-            })
+        # set status to finished
+        jobs_coll.update_one({"_id": job["_id"]}, {
+            "$set": {
+                "status": "finished",
+                "finished": datetime.now(),
+            }
+        })
 
-        except Exception as e:
-            short_description = "Exception occurred while running matching algorithm: " + e.__class__.__name__ + ": " \
-                                + str(e)
+        return None
 
-            print(short_description)
+    except Exception as e:
+        short_description = "Exception occurred while running matching algorithm: " + e.__class__.__name__ + ": " \
+                            + str(e)
 
-            # set status to failed
-            jobs_coll.update_one({"_id": job["_id"]},
-                                 {"$set": {"status": "error", "error": short_description, "finished": datetime.now()}})
+        print(short_description)
 
-            consecutive_error_number += 1
+        # set status to failed
+        jobs_coll.update_one({"_id": job["_id"]},
+                             {"$set": {"status": "error", "error": short_description, "finished": datetime.now()}})
 
-            if consecutive_error_number >= 5:
-                print("Too many consecutive errors, stopping")
-                break
+        return e
 
 
-def __spawn_job_pull_threads(db, sim_id, graph, num_threads=4):
+def __spawn_job_pull_threads(db, sim_id, graph, num_threads=4, batch_size=32):
     """
-    Spawn threads to pull jobs from the database and run the matching algorithm for each job.
+    Claim matching jobs in batches and run the matching algorithm for each job on a pool of worker threads.
     :param db: the database
     :param sim_id: the simulation id
     :param graph: the undirected graph to use for the matching
-    :param num_threads: the number of threads to spawn
+    :param num_threads: the number of worker threads
+    :param batch_size: the number of jobs to claim at once
     :return:
     """
-    threads = []
+    jobs_coll = db["matching-jobs"]
+    route_results_coll = db["route-results"]
 
-    for i in range(num_threads):
-        t = threading.Thread(target=__iterate_jobs, args=(db, sim_id, graph, i == 0, num_threads))
-        t.start()
-        threads.append(t)
+    # get total number of jobs, including the timed out ones that will be claimed again
+    total_jobs = jobs_coll.count_documents(__get_claimable_filter(sim_id))
 
-    for t in threads:
-        t.join()
+    if total_jobs == 0:
+        return
+
+    print("Running matching algorithm")
+
+    last_print = 0
+
+    def print_progress(processed_jobs, job):
+        nonlocal last_print
+
+        current_time = time.time()
+        if current_time - last_print > 1:
+            print("Progress: ~{:.2f}% {:}".format(min(1.0, processed_jobs / total_jobs) * 100, job["vc-id"]))
+            last_print = current_time
+
+    def release(jobs):
+        # put the jobs back so they can be picked up again right away
+        jobs_coll.update_many({"_id": {"$in": [job["_id"] for job in jobs]}},
+                              {"$set": {"status": "pending"}, "$unset": {"started": ""}})
+
+    def heartbeat(jobs):
+        # keep the jobs we still hold from timing out, also while they wait in the queue
+        jobs_coll.update_many({"_id": {"$in": [job["_id"] for job in jobs]}, "status": "running"},
+                              {"$set": {"started": datetime.now()}})
+
+    error = run_job_pool(lambda count: __claim_batch(jobs_coll, sim_id, count),
+                         lambda job: __process_job(jobs_coll, route_results_coll, job, sim_id, graph),
+                         release, threads=num_threads, batch_size=batch_size, max_consecutive_errors=4,
+                         tick=print_progress, heartbeat=heartbeat)
+
+    if error is not None:
+        print("Too many consecutive errors, stopping")
 
 
 def __find_results_with_osm_nodes(db, sim_id):
@@ -432,6 +451,10 @@ def run_matching(sim_id, place_name=None, num_threads=4, reset_jobs=False, recal
     """
     db = get_database()
 
+    ensure_index(db["matching-jobs"], [("vc-id", 1), ("sim-id", 1)], unique=True)
+    ensure_index(db["matching-jobs"], [("sim-id", 1), ("status", 1), ("started", 1)])
+    ensure_index(db["route-results"], [("vc-id", 1), ("sim-id", 1)], unique=True)
+
     __create_matching_jobs(db, sim_id)
     if reset_jobs:
         __reset_jobs(db, sim_id)
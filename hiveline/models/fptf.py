@@ -50,6 +50,8 @@ class Location:
     It can be used by other items to indicate their locations.
     """
 
+    __slots__ = ('type', 'name', 'address', 'longitude', 'latitude', 'altitude')
+
     def __init__(self, name=None, address=None, longitude=None, latitude=None, altitude=None):
         self.type = 'location'
         self.name = name
@@ -103,6 +105,8 @@ class Station:
     A station is a larger building or area that can be identified by a name.
     """
 
+    __slots__ = ('type', 'id', 'name', 'location', 'regions')
+
     def __init__(self, id: str, name: str, location: Location = None, regions: list = None):
         self.type = 'station'
         self.id = id
@@ -153,6 +157,8 @@ class Stop:
     A stop is a single small point or structure at which vehicles stop.
     """
 
+    __slots__ = ('type', 'id', 'station', 'name', 'location')
+
     def __init__(self, id: str, station: Station, name: str, location: Location = None):
         self.type = 'stop'
         self.id = id
@@ -551,6 +557,9 @@ class Stopover:
     A stopover is when a vehicle stops at a station or stop.
     """
 
+    __slots__ = ('type', 'stop', 'arrival', 'arrival_delay', 'arrival_platform', 'departure', 'departure_delay',
+                 'departure_platform')
+
     def __init__(self, stop: Stop | Station | Location, arrival: datetime.datetime = None, arrival_delay: int = None,
                  arrival_platform: str = None,
                  departure: datetime.datetime = None, departure_delay: int = None, departure_platform: str = None):
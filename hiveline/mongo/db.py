@@ -1,8 +1,10 @@
 import os
+import threading
 
 import dotenv
 import pandas as pd
 from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, OperationFailure
 
 
 def get_database():
@@ -46,6 +48,100 @@ def push_to_collection(db, collection, array):
     db[collection].bulk_write(operations)
 
 
+def ensure_index(coll, keys, unique=False):
+    """
+    Creates an index if it does not exist yet. create_index is idempotent, so this is safe to call on every run. If the
+    index can't be created (e.g. an index with the same keys but different options exists, or a unique index is
+    violated by existing data), a warning is printed and the existing state is kept.
+    :param coll: the collection
+    :param keys: list of (field, direction) tuples
+    :param unique: whether the index should be unique
+    :return:
+    """
+    try:
+        coll.create_index(keys, unique=unique)
+    except OperationFailure as e:
+        print("Could not create index " + str(keys) + " on " + coll.name + ": " + str(e))
+
+
+def insert_many_ignore_duplicates(coll, docs, chunk_size=1000):
+    """
+    Inserts many documents in chunks, skipping documents that violate a unique index. Other write errors are re-raised.
+    :param coll: the collection
+    :param docs: an iterable of documents to insert
+    :param chunk_size: the number of documents to send per round trip
+    :return:
+    """
+    chunk = []
+
+    for doc in docs:
+        chunk.append(doc)
+        if len(chunk) >= chunk_size:
+            __insert_chunk(coll, chunk)
+            chunk = []
+
+    if len(chunk) > 0:
+        __insert_chunk(coll, chunk)
+
+
+def __insert_chunk(coll, chunk):
+    try:
+        coll.insert_many(chunk, ordered=False)
+    except BulkWriteError as e:
+        # 11000 is the duplicate key error, i.e. the document already exists
+        errors = [err for err in e.details["writeErrors"] if err["code"] != 11000]
+        if len(errors) > 0 or e.details.get("writeConcernErrors"):
+            raise e
+
+
+class BulkWriteBuffer:
+    """
+    Collects write operations and sends them in one unordered bulk_write when flush() is called. Nothing is written
+    before that, so the caller decides when the buffered operations are written. Each operation can carry a key (e.g.
+    the job it belongs to), so the caller learns which operations were written. Safe to use from multiple threads.
+
+    :param coll: the collection to write to
+    """
+
+    def __init__(self, coll):
+        self.coll = coll
+        self.entries = []
+        self.lock = threading.Lock()
+
+    def add(self, op, key=None):
+        with self.lock:
+            self.entries.append((op, key))
+
+    def flush(self) -> tuple[list, list[tuple]]:
+        """
+        Writes the buffered operations. Operations rejected by the server (e.g. an invalid document) only fail
+        themselves, errors that leave the outcome of the whole write unknown (e.g. connection or write concern errors)
+        are raised.
+        :return: the keys of the written operations and (key, error) tuples of the rejected ones
+        """
+        with self.lock:
+            entries = self.entries
+            self.entries = []
+
+        if len(entries) == 0:
+            return [], []
+
+        try:
+            self.coll.bulk_write([op for (op, _) in entries], ordered=False)
+        except BulkWriteError as e:
+            if e.details.get("writeConcernErrors"):
+                raise e
+
+            # with unordered writes, the index refers to the position in the list of operations
+            errors = {err["index"]: err.get("errmsg", str(err)) for err in e.details["writeErrors"]}
+
+            written = [key for (i, (_, key)) in enumerate(entries) if i not in errors]
+            failed = [(entries[i][1], error) for (i, error) in errors.items()]
+            return written, failed
+
+        return [key for (_, key) in entries], []
+
+
 def mongo_to_df(db, collection):
     assert collection in db.list_collection_names(), "This collection doesn't exists"
     df = dict_to_df(db[collection])
@@ -1,9 +1,11 @@
 import datetime
+import functools
 import json
 import math
 import os.path
 from typing import Callable, Generator
 
+import numpy as np
 from shapely import Polygon, Point
 
 from hiveline.models import fptf
@@ -13,6 +15,19 @@ from hiveline.routing.util import ensure_directory
 
 rail_modes = [fptf.Mode.TRAIN, fptf.Mode.GONDOLA, fptf.Mode.WATERCRAFT]
 
+# Radius of the Earth in meters
+EARTH_RADIUS_M = 6_371_000.0
+
+# below this number of points, calling the cached scalar version per pair is cheaper than the fixed NumPy overhead
+VECTORIZE_MIN_POINTS = 16
+
+# local aliases, saves the attribute lookup on the math module in the hot distance functions
+_radians = math.radians
+_sin = math.sin
+_cos = math.cos
+_asin = math.asin
+_sqrt = math.sqrt
+
 
 class Journeys:
     def __init__(self, sim_id: str, db=None, use_cache=True, cache="./cache"):
@@ -177,37 +192,73 @@ class JourneyStats:
 
 def __approx_dist(origin: tuple[float, float], destination: tuple[float, float]):
     """
-    Approximate the distance between two points in meters using the Haversine formula.
+    Approximate the distance between two points in meters using the Haversine formula. Many journeys share the same
+    stops, so the coordinates are rounded to 6 decimals (about 11cm) and the result is cached.
 
     :param origin: object with fields lon, lat
     :param destination: object with fields lon, lat
     :return: distance in meters
     """
+    return _dist_cached(round(origin[0], 6), round(origin[1], 6), round(destination[0], 6), round(destination[1], 6))
 
-    # Convert latitude and longitude from degrees to radians
-    lon1 = math.radians(origin[0])
-    lat1 = math.radians(origin[1])
-    lon2 = math.radians(destination[0])
-    lat2 = math.radians(destination[1])
 
-    # Radius of the Earth in kilometers
-    r = 6371.0
+@functools.lru_cache(maxsize=1 << 18)
+def _dist_cached(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    # Convert latitude and longitude from degrees to radians
+    lon1 = _radians(lon1)
+    lat1 = _radians(lat1)
+    lon2 = _radians(lon2)
+    lat2 = _radians(lat2)
 
     # Difference in coordinates
     d_lon = lon2 - lon1
     d_lat = lat2 - lat1
 
-    # Haversine formula
-    a = math.sin(d_lat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(d_lon / 2) ** 2
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    # Haversine formula (arcsin form, so we only need one sqrt)
+    a = _sin(d_lat / 2) ** 2 + _cos(lat1) * _cos(lat2) * _sin(d_lon / 2) ** 2
 
-    # Distance in kilometers
-    distance_km = r * c
+    return 2 * EARTH_RADIUS_M * _asin(_sqrt(min(1.0, a)))
+
+
+def _haversine_vec(lon1: np.ndarray, lat1: np.ndarray, lon2: np.ndarray, lat2: np.ndarray) -> np.ndarray:
+    """
+    Vectorized version of __approx_dist. Approximates the distances between pairs of points in meters.
+
+    :param lon1: longitudes of the origins in degrees
+    :param lat1: latitudes of the origins in degrees
+    :param lon2: longitudes of the destinations in degrees
+    :param lat2: latitudes of the destinations in degrees
+    :return: distances in meters
+    """
+    lon1 = np.deg2rad(lon1)
+    lat1 = np.deg2rad(lat1)
+    lon2 = np.deg2rad(lon2)
+    lat2 = np.deg2rad(lat2)
 
-    # Convert to meters
-    distance_meters = distance_km * 1000
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
 
-    return distance_meters
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+def __approx_dist_many(points: list[tuple[float, float]]) -> list[float]:
+    """
+    Approximate the distances between consecutive points in meters. Short lists use the scalar version, as the
+    vectorized one has a fixed overhead.
+
+    :param points: list of (lon, lat) tuples
+    :return: list of len(points) - 1 distances in meters
+    """
+    if len(points) < VECTORIZE_MIN_POINTS:
+        return [__approx_dist(points[i], points[i + 1]) for i in range(len(points) - 1)]
+
+    coords = np.asarray(points, dtype=float)
+
+    # missing coordinates (None) become NaN here. the scalar version raises for them like before, instead of silently
+    # adding NaN to the distance sums
+    if np.isnan(coords).any():
+        return [__approx_dist(points[i], points[i + 1]) for i in range(len(points) - 1)]
+
+    return _haversine_vec(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1]).tolist()
 
 
 def get_option_stats(option: Option, shape: Polygon | None = None) -> JourneyStats:
@@ -257,13 +308,16 @@ def get_trace_stats(trace: list[tuple[tuple[float, float], datetime.datetime, fp
     """
     stats = JourneyStats()
 
+    # calculate all distances at once, long traces are a lot cheaper vectorized than with the scalar version per point
+    dists = __approx_dist_many([t[0] for t in trace])
+
     for (i, (from_point, _, from_mode, is_leg_start)) in enumerate(trace[:-1]):
         to_point, _, to_mode, _ = trace[i + 1]
 
         if from_mode != to_mode:
             continue
 
-        dist = __approx_dist(from_point, to_point)
+        dist = dists[i]
         pax = 1 if is_leg_start else 0
 
         if from_mode == fptf.Mode.CAR:
@@ -305,8 +359,7 @@ def __get_distance(leg: fptf.Leg) -> float:
     stopover_locations = [fptf.get_location(stopover.stop) for stopover in leg.stopovers]
     stopover_locations = [loc for loc in stopover_locations if loc is not None]
 
-    distances = [__approx_dist_fptf(stopover_locations[i], stopover_locations[i + 1]) for i in
-                 range(len(stopover_locations) - 1)]
+    distances = __approx_dist_many([(loc.longitude, loc.latitude) for loc in stopover_locations])
 
     return sum(distances)
 
@@ -49,18 +49,23 @@ def decide(options: Options, params: Params = None) -> Option | None:
     if not would_use_car and has_car and random.random() < params.car_usage_override:
         would_use_car = True
 
-    valid_options = options.options
+    # choose the fastest valid option, filtering and comparing in one pass
+    fastest = None
+    fastest_duration = None
 
-    if not would_use_car:
-        valid_options = [o for o in valid_options if not o.has_car()]
+    for o in options.options:
+        if not would_use_car and o.has_car():
+            continue
 
-    if len(valid_options) == 0:
-        return None
+        duration = o.journey.duration()
+        if duration is None:
+            duration = 0
 
-    durations = [o.journey.duration() for o in valid_options]
-    durations = [d if d is not None else 0 for d in durations]
+        if fastest is None or duration < fastest_duration:
+            fastest = o
+            fastest_duration = duration
 
-    return valid_options[durations.index(min(durations))]  # choose the fastest option
+    return fastest
 
 
 def __option_has_car(option):
@@ -79,15 +84,18 @@ def __option_has_car(option):
 
 def merge_journey_stats(stats: list[JourneyStats]) -> JourneyStats:
     result = JourneyStats()
-    result.car_meters = sum([s.car_meters for s in stats])
-    result.rail_meters = sum([s.rail_meters for s in stats])
-    result.bus_meters = sum([s.bus_meters for s in stats])
-    result.walk_meters = sum([s.walk_meters for s in stats])
-
-    result.car_passengers = sum([s.car_passengers for s in stats])
-    result.rail_passengers = sum([s.rail_passengers for s in stats])
-    result.bus_passengers = sum([s.bus_passengers for s in stats])
-    result.walkers = sum([s.walkers for s in stats])
+
+    # one pass over all stats instead of one per field
+    for s in stats:
+        result.car_meters += s.car_meters
+        result.rail_meters += s.rail_meters
+        result.bus_meters += s.bus_meters
+        result.walk_meters += s.walk_meters
+
+        result.car_passengers += s.car_passengers
+        result.rail_passengers += s.rail_passengers
+        result.bus_passengers += s.bus_passengers
+        result.walkers += s.walkers
 
     return result
 
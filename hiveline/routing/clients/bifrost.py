@@ -1,8 +1,8 @@
 import datetime
 import json
 
-import requests
 from hiveline.routing.clients.routing_client import RoutingClient
+from hiveline.routing.util import get_session
 from hiveline.models import fptf
 
 
@@ -56,7 +56,7 @@ class BifrostRoutingClient(RoutingClient):
         }
 
         # Send the request to the OTP GraphQL endpoint
-        response = requests.post(url, json=req, headers=headers, timeout=self.client_timeout)
+        response = get_session().post(url, json=req, headers=headers, timeout=self.client_timeout)
 
         if response.status_code != 200:
             print("Error querying Bifrost:", response.status_code)
@@ -0,0 +1,73 @@
+import datetime
+import threading
+from collections import OrderedDict
+
+import h3
+
+from hiveline.models import fptf
+from hiveline.routing.clients.routing_client import RoutingClient
+
+
+class CachedRoutingClient(RoutingClient):
+    def __init__(self, base: RoutingClient, resolution=10, time_bucket_seconds=300, max_size=100000):
+        """
+        Memoizes the journeys of a routing client. Origins and destinations are snapped to the center of their H3 cell
+        and departures are floored to a time bucket, so commuters living close to each other and leaving at roughly
+        the same time share one request. Only use this with deterministic clients (i.e. not with delays).
+
+        :param base: the routing client to query on cache misses
+        :param resolution: the H3 resolution used for snapping (10 is roughly 65m edge length)
+        :param time_bucket_seconds: the size of the departure time buckets in seconds
+        :param max_size: the maximum number of cached queries
+        """
+        self.base = base
+        self.resolution = resolution
+        self.time_bucket_seconds = time_bucket_seconds
+        self.max_size = max_size
+
+        self.cache: OrderedDict[tuple, list[fptf.Journey]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __get_bucket(self, departure: datetime.datetime) -> datetime.datetime:
+        seconds = departure.hour * 3600 + departure.minute * 60 + departure.second
+        return departure - datetime.timedelta(seconds=seconds % self.time_bucket_seconds,
+                                              microseconds=departure.microsecond)
+
+    def get_journeys(self, from_lat: float, from_lon: float, to_lat: float, to_lon: float, departure: datetime.datetime,
+                     modes: list[fptf.Mode]) -> list[fptf.Journey] | None:
+        """
+        Get routes from the cache or, on a miss, from the base client. Failed requests (None) are not cached.
+        :param from_lat: the latitude of the starting point
+        :param from_lon: the longitude of the starting point
+        :param to_lat: the latitude of the destination
+        :param to_lon: the longitude of the destination
+        :param departure: the departure time as datetime object
+        :param modes: the fptf modes to use for routing
+        :return: a list of fptf journey
+        """
+        origin_cell = h3.geo_to_h3(from_lat, from_lon, self.resolution)
+        destination_cell = h3.geo_to_h3(to_lat, to_lon, self.resolution)
+        bucket = self.__get_bucket(departure)
+
+        key = (origin_cell, destination_cell, bucket, tuple(modes))
+
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                return list(self.cache[key])
+
+        origin_lat, origin_lon = h3.h3_to_geo(origin_cell)
+        destination_lat, destination_lon = h3.h3_to_geo(destination_cell)
+
+        journeys = self.base.get_journeys(origin_lat, origin_lon, destination_lat, destination_lon, bucket, modes)
+
+        if journeys is None:
+            return None
+
+        with self.lock:
+            self.cache[key] = journeys
+            self.cache.move_to_end(key)
+            if len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
+
+        return list(journeys)
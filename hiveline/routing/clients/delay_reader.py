@@ -3,7 +3,6 @@ from os import listdir
 from os.path import isfile, join
 
 import pandas as pd
-import pymongo.errors
 
 import hiveline.mongo.db as mongo
 
@@ -58,7 +57,4 @@ def read_and_upload_statistics(directory):
             "cancelled_percent": cancelled_percent
         }
 
-        try:
-            coll.insert_one(dict(doc))
-        except pymongo.errors.DuplicateKeyError:
-            coll.replace_one({"name": normalized_name}, doc)
+        coll.replace_one({"name": normalized_name}, doc, upsert=True)
@@ -1,9 +1,9 @@
 import datetime
 
 import polyline
-import requests
 
 from hiveline.routing.clients.routing_client import RoutingClient
+from hiveline.routing.util import get_session
 from hiveline.models import fptf
 
 
@@ -138,7 +138,7 @@ class OpenTripPlannerRoutingClient(RoutingClient):
         }
 
         # Send the request to the OTP GraphQL endpoint
-        response = requests.post(url, json={'query': query}, headers=headers, timeout=self.client_timeout)
+        response = get_session().post(url, json={'query': query}, headers=headers, timeout=self.client_timeout)
 
         # Check if the request was successful
         if response.status_code != 200:
@@ -126,12 +126,17 @@ class OpenTripPlannerRoutingServer(RoutingServer):
             print("Terminating server...")
 
             try:
-                if CURRENT_OS == 'Linux' or CURRENT_OS == 'Darwin':
-                    self.process.kill()
-                elif CURRENT_OS == 'Windows':
+                if CURRENT_OS == 'Windows':
                     os.kill(self.process.pid, signal.CTRL_C_EVENT)  # clean shutdown with CTRL+C
+                else:
+                    self.process.send_signal(signal.SIGINT)  # clean shutdown, same as CTRL+C
 
-                self.process.wait()
+                try:
+                    self.process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    print("Server did not shut down in time, killing it")
+                    self.process.kill()
+                    self.process.wait()
             except KeyboardInterrupt:
                 pass
 
@@ -1,5 +1,8 @@
 import os
 import pathlib
+import threading
+
+import requests
 
 
 def ensure_directory(path):
@@ -45,3 +48,19 @@ def iterate_output(stream, debug=False, debug_prefix="[process] "):
             break
         if debug:
             print(debug_prefix + line.strip())
+
+
+_local = threading.local()
+
+
+def get_session() -> requests.Session:
+    """
+    Get the requests session of the current thread. Sessions keep the connections to the routing server alive between
+    requests, but are not thread-safe, so every worker thread gets its own.
+    :return: the session of the current thread
+    """
+    session = getattr(_local, "session", None)
+    if session is None:
+        session = requests.Session()
+        _local.session = session
+    return session
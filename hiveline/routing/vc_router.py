@@ -9,17 +9,19 @@ if __name__ == "__main__":
 
 import argparse
 import datetime
+import signal
 import time
 import uuid
 
-import pymongo.errors
+from pymongo import UpdateOne
 
-from hiveline.jobs.jobs import JobHandler, JobStatus
+from hiveline.jobs.jobs import JobHandler
 from hiveline.jobs.mongo import MongoJobsDataSource
 from hiveline.models import fptf
 from hiveline.models.options import Option
-from hiveline.mongo.db import get_database
+from hiveline.mongo.db import get_database, BulkWriteBuffer, ensure_index
 from hiveline.routing import resource_builder
+from hiveline.routing.clients.cached import CachedRoutingClient
 from hiveline.routing.clients.delayed import DelayedRoutingClient
 from hiveline.routing.clients.routing_client import RoutingClient
 from hiveline.routing.servers.routing_server import RoutingServer
@@ -33,49 +35,32 @@ def __create_route_calculation_jobs(db, sim_id, job_handler):
     :param sim_id: the simulation id
     :return:
     """
-    pipeline = [
-        {
-            "$match": {
-                "sim-id": sim_id
-            }
-        },
-        {
-            "$project": {
-                "vc-id": "$vc-id",
-            }
-        }
-    ]
-
     coll = db["virtual-commuters"]
 
-    result = coll.aggregate(pipeline)
-    job_ids = [vc["vc-id"] for vc in result]
+    # stream the ids in large batches of tiny documents instead of materializing all commuters
+    result = coll.find({"sim-id": sim_id}, {"vc-id": 1, "_id": 0}).batch_size(5000)
 
-    job_handler.create_jobs(job_ids)
+    job_handler.create_jobs(vc["vc-id"] for vc in result)
 
 
-def __get_route_results(client: RoutingClient, vc: dict, sim: dict, modes: list[fptf.Mode]) -> list[Option] | None:
+def __get_route_results(client: RoutingClient, origin: fptf.Location, destination: fptf.Location,
+                        departure: datetime.datetime, modes: list[fptf.Mode]) -> list[Option] | None:
     """
     Get a route for a virtual commuter.
     :param client: The routing client
-    :param vc: The virtual commuter
-    :param sim: The simulation
+    :param origin: The origin of the virtual commuter
+    :param destination: The destination of the virtual commuter
+    :param departure: The departure time
     :param modes: The modes to use
     :return:
     """
-    origin = vc_extract.extract_origin_loc(vc)
-    destination = vc_extract.extract_destination_loc(vc)
-    departure = vc_extract.extract_departure(vc, sim)
-
-    journeys = client.get_journeys(origin[1], origin[0], destination[1], destination[0], departure, modes)
+    journeys = client.get_journeys(origin.latitude, origin.longitude, destination.latitude, destination.longitude,
+                                   departure, modes)
 
     if journeys is None:
         return None
 
-    origin_fptf = fptf.Location(longitude=origin[0], latitude=origin[1])
-    destination_fptf = fptf.Location(longitude=destination[0], latitude=destination[1])
-
-    return [Option(str(uuid.uuid4()), origin_fptf, destination_fptf, departure, modes, journey) for journey in journeys]
+    return [Option(str(uuid.uuid4()), origin, destination, departure, modes, journey) for journey in journeys]
 
 
 def __route_virtual_commuter(client: RoutingClient, vc: dict, sim: dict) -> list[Option]:
@@ -91,7 +76,16 @@ def __route_virtual_commuter(client: RoutingClient, vc: dict, sim: dict) -> list
     #  if vc_extract.has_motor_vehicle(vc):
     mode_combinations += [[fptf.Mode.WALKING, fptf.Mode.CAR]]
 
-    option_lists = [__get_route_results(client, vc, sim, modes) for modes in mode_combinations]
+    # these are the same for all mode combinations, so we only extract them once
+    origin = vc_extract.extract_origin_loc(vc)
+    destination = vc_extract.extract_destination_loc(vc)
+    departure = vc_extract.extract_departure(vc, sim)
+
+    origin_fptf = fptf.Location(longitude=origin[0], latitude=origin[1])
+    destination_fptf = fptf.Location(longitude=destination[0], latitude=destination[1])
+
+    option_lists = [__get_route_results(client, origin_fptf, destination_fptf, departure, modes) for modes in
+                    mode_combinations]
     options = []
 
     for option_list in option_lists:
@@ -104,13 +98,13 @@ def __route_virtual_commuter(client: RoutingClient, vc: dict, sim: dict) -> list
     return options
 
 
-def __process_virtual_commuter(client, route_results_coll, vc_coll, vc_id, sim, meta):
-    vc = vc_coll.find_one({"vc-id": vc_id, "sim-id": sim["sim-id"]})
+def __process_virtual_commuter(client, route_results_buffer, vc_coll, vc_id, sim, meta):
+    vc = vc_coll.find_one({"vc-id": vc_id, "sim-id": sim["sim-id"]}, vc_extract.routing_projection)
 
     should_route = vc_extract.should_route(vc)
 
     if not should_route:
-        return
+        return False
 
     options = __route_virtual_commuter(client, vc, sim)
 
@@ -128,12 +122,12 @@ def __process_virtual_commuter(client, route_results_coll, vc_coll, vc_id, sim,
         "meta": meta
     }
 
-    try:
-        route_results_coll.insert_one(route_results)
-    except pymongo.errors.DuplicateKeyError:
-        if "_id" in route_results:
-            del route_results["_id"]
-        route_results_coll.update_one({"vc-id": vc["vc-id"], "sim-id": vc["sim-id"]}, {"$set": route_results})
+    # results are written in bulk by the job handler, existing results of the same commuter are overwritten
+    route_results_buffer.add(UpdateOne({"vc-id": vc["vc-id"], "sim-id": vc["sim-id"]}, {"$set": route_results},
+                                       upsert=True), vc_id)
+
+    # the job is set to finished once its results are written
+    return True
 
 
 def __route_virtual_commuters(server: RoutingServer, client: RoutingClient, sim_id, data_dir="./cache", use_delays=True,
@@ -157,6 +151,9 @@ def __route_virtual_commuters(server: RoutingServer, client: RoutingClient, sim_
     if db is None:
         db = get_database()
 
+    ensure_index(db["virtual-commuters"], [("sim-id", 1), ("vc-id", 1)])
+    ensure_index(db["route-results"], [("vc-id", 1), ("sim-id", 1)], unique=True)
+
     job_handler = JobHandler("routing", sim_id, MongoJobsDataSource(db=db))
 
     if reset_jobs:
@@ -166,9 +163,9 @@ def __route_virtual_commuters(server: RoutingServer, client: RoutingClient, sim_
         job_handler.reset_failed_jobs()
 
     __create_route_calculation_jobs(db, sim_id, job_handler)
-    job_handler.reset_timed_out_jobs()
 
-    if job_handler.count_jobs(status=JobStatus.PENDING) == 0:
+    # timed out jobs are claimed again while iterating, so they count as active
+    if job_handler.count_claimable_jobs() == 0:
         print("No active jobs, stopping")
         return
 
@@ -189,10 +186,11 @@ def __route_virtual_commuters(server: RoutingServer, client: RoutingClient, sim_
         "osm": [{"source": source} for source in config.osm_files],
         "gtfs": [{"source": source} for source in config.gtfs_files],
         "router": server.get_meta(),
-        "uses-delay-simulation": use_delays
+        "uses-delay-simulation": use_delays,
+        "uses-route-cache": isinstance(client, CachedRoutingClient)
     }
 
-    route_results_coll = db["route-results"]
+    route_results_buffer = BulkWriteBuffer(db["route-results"])
     vc_coll = db["virtual-commuters"]
 
     server.start(config, server_files)
@@ -202,9 +200,10 @@ def __route_virtual_commuters(server: RoutingServer, client: RoutingClient, sim_
 
         t = datetime.datetime.now()
 
+        # the job handler flushes the buffered results and sets jobs to finished once their results are written
         job_handler.iterate_jobs(
-            lambda job_id: __process_virtual_commuter(client, route_results_coll, vc_coll, job_id, sim, meta),
-            threads=num_threads, debug_progress=True)
+            lambda job_id: __process_virtual_commuter(client, route_results_buffer, vc_coll, job_id, sim, meta),
+            threads=num_threads, debug_progress=True, flush=route_results_buffer.flush)
 
         print("Finished routing algorithm in " + str(datetime.datetime.now() - t))
 
@@ -235,17 +234,20 @@ def __get_profile_without_delay(profile_str: str, threads=12, memory_gb: int = 4
 
 
 def __get_profile(profile_str: str, use_delays: bool = False, threads=4, memory_gb: int = 4, api_timeout: float = 10,
-                  client_timeout: float = 20) -> [RoutingServer, RoutingClient]:
+                  client_timeout: float = 20, cache_routes: bool = False) -> [RoutingServer, RoutingClient]:
     [server, client] = __get_profile_without_delay(profile_str, threads=threads, memory_gb=memory_gb,
                                                    api_timeout=api_timeout, client_timeout=client_timeout)
     if use_delays:
+        # delayed journeys are randomized per commuter, so they are never cached
         return server, DelayedRoutingClient(client)
+    if cache_routes:
+        return server, CachedRoutingClient(client)
     return server, client
 
 
 def route_virtual_commuters(sim_id, profile="opentripplanner", data_dir="./cache", use_delays=True,
                             force_graph_rebuild=False, memory_gb=4, num_threads=4,
-                            reset_jobs=False, reset_failed=False, timeout=20):
+                            reset_jobs=False, reset_failed=False, timeout=20, cache_routes=False):
     """
     Run the routing algorithm for a virtual commuter set. It will spawn a new process and run the routing algorithm
     for all open jobs in the database. It will also update the database with the results of the routing algorithm.
@@ -259,16 +261,26 @@ def route_virtual_commuters(sim_id, profile="opentripplanner", data_dir="./cache
     :param reset_jobs: Whether to reset all jobs to pending or not
     :param reset_failed: Whether to reset all failed jobs to pending or not
     :param timeout: The timeout for the client (in seconds), server will use half of that as API timeout
+    :param cache_routes: Whether to share routes between commuters with nearby origins, destinations and departures
+    (ignored when using delays)
     :return:
     """
 
     profile_server, profile_client = __get_profile(profile, use_delays, threads=num_threads, memory_gb=memory_gb,
-                                                   client_timeout=timeout, api_timeout=timeout / 2)
+                                                   client_timeout=timeout, api_timeout=timeout / 2,
+                                                   cache_routes=cache_routes)
     __route_virtual_commuters(profile_server, profile_client, sim_id, data_dir=data_dir, use_delays=use_delays,
                               force_graph_rebuild=force_graph_rebuild, num_threads=num_threads, reset_jobs=reset_jobs,
                               reset_failed=reset_failed)
 
 
+def __handle_sigterm(signum, frame):
+    # treat SIGTERM like CTRL+C. the job handler puts queued jobs back, waits only for the running ones and flushes
+    # their results, then the routing server is stopped. further signals are ignored so they don't cut that short.
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Run the routing algorithm for a virtual commuter set')
     parser.add_argument('sim_id', type=str, help='Simulation id')
@@ -289,12 +301,18 @@ if __name__ == "__main__":
                                                                                          'jobs for this simulation')
     parser.add_argument('--timeout', dest='timeout', type=int, default=20,
                         help='The timeout for the client (in seconds), server will use half of that as API timeout')
+    parser.add_argument('--cache-routes', dest='cache_routes', action='store_true',
+                        help='Whether to share routes between commuters with nearby origins, destinations and '
+                             'departures (ignored when using delays)')
 
     args = parser.parse_args()
 
+    signal.signal(signal.SIGTERM, __handle_sigterm)
+
     try:
         route_virtual_commuters(args.sim_id, args.profile, args.data_dir, not args.no_delays, args.force_graph_rebuild,
-                                args.memory_db, args.num_threads, args.reset_jobs, args.reset_failed, args.timeout)
+                                args.memory_db, args.num_threads, args.reset_jobs, args.reset_failed, args.timeout,
+                                args.cache_routes)
     except Exception as e:
         print("Exception occurred while running routing algorithm: " + e.__class__.__name__ + ": " + str(e))
         time.sleep(10000)
@@ -24,7 +24,7 @@ CURRENT_OS = platform.system()  # 'Windows', 'Linux' or 'Darwin' (MacOS)
 
 def route_virtual_commuters(sim_id, profile="opentripplanner", data_dir="./cache", use_delays=True,
                             force_graph_rebuild=False, memory_gb=4, num_threads=4,
-                            reset_jobs=False, reset_failed=False, timeout=20):
+                            reset_jobs=False, reset_failed=False, timeout=20, cache_routes=False):
     """
     Run the routing algorithm for a virtual commuter set. It will spawn a new process and run the routing algorithm
     for all open jobs in the database. It will also update the database with the results of the routing algorithm.
@@ -38,11 +38,13 @@ def route_virtual_commuters(sim_id, profile="opentripplanner", data_dir="./cache
     :param reset_jobs: Whether to reset all jobs to pending or not
     :param reset_failed: Whether to reset all failed jobs to pending or not
     :param timeout: The timeout for the client (in seconds), server will use half of that as API timeout
+    :param cache_routes: Whether to share routes between commuters with nearby origins, destinations and departures
+    (ignored when using delays)
     :return:
     """
     if CURRENT_OS == 'Linux':
         vc_router.route_virtual_commuters(sim_id, profile, data_dir, use_delays, force_graph_rebuild, memory_gb,
-                                          num_threads, reset_jobs, reset_failed, timeout)
+                                          num_threads, reset_jobs, reset_failed, timeout, cache_routes)
         return
 
     base_path = os.getenv("PROJECT_PATH")
@@ -66,6 +68,9 @@ def route_virtual_commuters(sim_id, profile="opentripplanner", data_dir="./cache
     if reset_failed:
         args.append("--reset-failed")
 
+    if cache_routes:
+        args.append("--cache-routes")
+
     print("[WRAPPER] Running routing algorithm for sim_id %s" % sim_id)
 
     try:
@@ -102,8 +107,12 @@ if __name__ == "__main__":
                                                                                          'jobs for this simulation')
     parser.add_argument('--timeout', dest='timeout', type=int, default=20,
                         help='The timeout for the client (in seconds), server will use half of that as API timeout')
+    parser.add_argument('--cache-routes', dest='cache_routes', action='store_true',
+                        help='Whether to share routes between commuters with nearby origins, destinations and '
+                             'departures (ignored when using delays)')
 
     args = parser.parse_args()
 
     route_virtual_commuters(args.sim_id, args.profile, args.data_dir, not args.no_delays, args.force_graph_rebuild,
-                            args.memory_gb, args.num_threads, args.reset_jobs, args.reset_failed, args.timeout)
+                            args.memory_gb, args.num_threads, args.reset_jobs, args.reset_failed, args.timeout,
+                            args.cache_routes)
@@ -1,8 +1,6 @@
 import datetime
 import uuid
 
-import pymongo.errors
-
 from hiveline.mongo.db import get_database
 
 
@@ -16,10 +14,7 @@ def __copy_virtual_commuters(db, from_sim_id, to_sim_id):
         doc["created-by"] = "virtual commuter duplicator"
         doc["created-from-vc-id"] = doc["vc-id"]
 
-        try:
-            vc.insert_one(doc)
-        except pymongo.errors.DuplicateKeyError:
-            vc.update_one({"sim-id": to_sim_id, "vc-id": doc["vc-id"]}, {"$set": doc})
+        vc.update_one({"sim-id": to_sim_id, "vc-id": doc["vc-id"]}, {"$set": doc}, upsert=True)
 
 
 def duplicate_simulation(db, sim_id, new_sim_id=None, new_date=None, copy_vc=True):
@@ -1,6 +1,20 @@
 import time
 from datetime import datetime, date
 
+# projection of the virtual commuter fields that are read by the routing related functions in this module
+routing_projection = {
+    "_id": 0,
+    "vc-id": 1,
+    "sim-id": 1,
+    "origin": 1,
+    "destination": 1,
+    "created": 1,
+    "employed": 1,
+    "employment_type": 1,
+    "vehicles": 1,
+    "age": 1,
+}
+
 
 def extract_origin_loc(vc):
     """